@@ -4,5 +4,11 @@ class Settings:
     NEO4J_URI = os.getenv("NEO4J_URI", "neo4j://127.0.0.1:7687")
     NEO4J_USER = os.getenv("NEO4J_USER", "neo4j")
     NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "Nigger")
+    NEO4J_DATABASE = os.getenv("NEO4J_DATABASE", "neo4j")
+    # "gds" runs PageRank/Louvain inside Neo4j, "networkit" computes them in-process
+    # (needs requirements-networkit.txt)
+    GRAPH_ANALYTICS_ENGINE = os.getenv("GRAPH_ANALYTICS_ENGINE", "gds")
+    # Upper bound for GDS algorithm concurrency; Community Edition rejects more than 4
+    GDS_CONCURRENCY = int(os.getenv("GDS_CONCURRENCY", "4"))
 
 settings = Settings()
@@ -1,7 +1,13 @@
-from fastapi import APIRouter, Request, Depends
+from fastapi import APIRouter, Request, Depends, BackgroundTasks, Query
+from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 from app.services.fraud_rules import fraud_rules
+from app.services.graph_service import get_session, fetch_single, neighbourhood_to_graph
 from app.core.config import settings
+import importlib.util
+import logging
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/investigation",
@@ -9,47 +15,103 @@ router = APIRouter(
 )
 
 templates = Jinja2Templates(directory="app/templates")
+investigation_template = templates.get_template("investigation.html")
+
+# Constant query text so Neo4j can reuse the cached plan; txId is a parameter.
+# Only the properties the graph view draws are returned, and each side's
+# neighbours are fetched in their own subquery (no sender x receiver
+# product) that stops after $limit distinct neighbours.
+GRAPH_QUERY = """
+MATCH (sender:Client)-[t:TRANSACTED {txId: $txId}]->(receiver:Client)
+
+CALL {
+    WITH sender
+    MATCH (sender)-[:TRANSACTED]-(n1:Client)
+    WITH DISTINCT n1 LIMIT $limit
+    RETURN collect(n1 {.id, .pagerankScore, .communityId}) AS n1s
+}
+CALL {
+    WITH receiver
+    MATCH (receiver)-[:TRANSACTED]-(n2:Client)
+    WITH DISTINCT n2 LIMIT $limit
+    RETURN collect(n2 {.id, .pagerankScore, .communityId}) AS n2s
+}
+
+RETURN sender {.id, .pagerankScore, .communityId} AS sender,
+       receiver {.id, .pagerankScore, .communityId} AS receiver,
+       t.amount AS amount,
+       t.type AS type,
+       t.isFraud AS isFraud,
+       n1s,
+       n2s
+"""
 
 @router.get("/{transaction_id}")
-async def investigate_transaction(request: Request, transaction_id: str):
+async def investigate_transaction(
+    request: Request,
+    transaction_id: str,
+    limit: int = Query(50, ge=1, le=200),
+    session=Depends(get_session)
+):
     
     # 1. ✅ Run Fraud Analysis BY txId ON RELATIONSHIP
-    fraud_context = fraud_rules.explain_fraud(transaction_id)
+    fraud_context = await fraud_rules.explain_fraud(transaction_id, session)
 
-    # 2. ✅ CORRECT Cypher for Neovis (RELATIONSHIP-BASED)
-    cypher_query = f"""
-    MATCH (sender:Client)-[t:TRANSACTED {{txId: '{transaction_id}'}}]->(receiver:Client)
+    # 2. Fetch the neighbourhood server-side, the browser only renders it
+    record = await session.execute_read(fetch_single, GRAPH_QUERY, {"txId": transaction_id, "limit": limit})
+    graph_json = neighbourhood_to_graph(record)
 
-    OPTIONAL MATCH (sender)-[t1:TRANSACTED]-(n1:Client)
-    OPTIONAL MATCH (receiver)-[t2:TRANSACTED]-(n2:Client)
-
-    RETURN sender, receiver, n1, n2, t, t1, t2
-    LIMIT 50
-    """
-
-    return templates.TemplateResponse("investigation.html", {
+    return HTMLResponse(investigation_template.render({
         "request": request,
         "fraud_context": fraud_context,
         "fraud_status": fraud_context["status"],   # ✅ FORCE PASS
-        "cypher_query": cypher_query,
-        "neo4j_uri": settings.NEO4J_URI,
-        "neo4j_user": settings.NEO4J_USER,
-        "neo4j_password": settings.NEO4J_PASSWORD
-    })
+        "graph_json": graph_json
+    }))
+
 
 
+# Set by the /run-gds handler and cleared when the task ends, so two runs
+# never drop or re-project the graph under each other.
+gds_running = False
+
+
+async def run_gds_and_clear_cache():
+    global gds_running
+    try:
+        from app.services.graph_service import graph_service
+        if settings.GRAPH_ANALYTICS_ENGINE == "networkit":
+            await graph_service.run_offline_pipeline()
+        else:
+            await graph_service.run_gds_pipeline()
+        await graph_service.precompute_rule_flags()
+        # Ranks, communities and rule flags changed, cached explanations are stale.
+        fraud_rules.clear_cache()
+        logger.info("GDS Pipeline executed successfully.")
+    except Exception:
+        logger.exception("GDS Pipeline failed.")
+    finally:
+        gds_running = False
+
 
 @router.post("/run-gds")
-async def run_gds_pipeline():
+async def run_gds_pipeline(background_tasks: BackgroundTasks):
     """
-    Trigger the Graph Data Science pipeline:
+    Queue the Graph Data Science pipeline:
     1. Create Projection
     2. Run Louvain
     3. Run PageRank
+    4. Precompute fan-in / circular-flow flags
+    Only one run at a time; a request during a run is not queued.
     """
-    try:
-        from app.services.graph_service import graph_service
-        graph_service.run_gds_pipeline()
-        return {"status": "success", "message": "GDS Pipeline executed successfully."}
-    except Exception as e:
-        return {"status": "error", "message": str(e)}
+    global gds_running
+    if settings.GRAPH_ANALYTICS_ENGINE == "networkit" and importlib.util.find_spec("networkit") is None:
+        return {
+            "status": "error",
+            "message": "GRAPH_ANALYTICS_ENGINE is 'networkit' but networkit is not installed "
+                       "(pip install -r requirements-networkit.txt)."
+        }
+    if gds_running:
+        return {"status": "running", "message": "GDS Pipeline is already running."}
+    gds_running = True
+    background_tasks.add_task(run_gds_and_clear_cache)
+    return {"status": "queued", "message": "GDS Pipeline scheduled."}
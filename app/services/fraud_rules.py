@@ -1,134 +1,128 @@
-from app.services.graph_service import graph_service
+from cachetools import TTLCache
+from app.services.graph_service import fetch_single
+
+# Reads the flags written by GraphService.precompute_rule_flags. The
+# subqueries compute them live only for transactions the precompute has not
+# covered yet; otherwise their WHERE filters leave them no work. Both always
+# return one row (aggregation), so they never drop the transaction.
+_EXPLAIN_Q = """
+MATCH (s:Client)-[t:TRANSACTED {txId: $txId}]->(r:Client)
+CALL {
+    WITH r, t
+    WITH r, t WHERE t.fanInScore IS NULL
+    MATCH (other:Client)-[o:TRANSACTED]->(r)
+    WHERE o.step >= t.step - $window_steps AND o.step <= t.step
+    RETURN count(DISTINCT other) AS live_fan_in
+}
+CALL {
+    WITH s, r, t
+    WITH s, r, t WHERE t.inCycle IS NULL AND s <> r
+    OPTIONAL MATCH path = shortestPath((r)-[:TRANSACTED*..4]->(s))
+    RETURN min(length(path)) + 1 AS live_cycle_len
+}
+RETURN 
+    s.id AS sender,
+    r.id AS receiver,
+    t.amount AS amount,
+    t.type AS type,
+    t.step AS step,
+    t.isFraud AS isFraud,
+    coalesce(t.ruleFlaggedFraud, false) AS ruleFlaggedFraud,
+    s.pagerankScore AS sender_rank,
+    s.communityId   AS sender_community,
+    r.pagerankScore AS receiver_rank,
+    r.communityId   AS receiver_community,
+    coalesce(t.fanInScore, live_fan_in) AS fan_in,
+    coalesce(t.inCycle, live_cycle_len IS NOT NULL) AS in_cycle,
+    coalesce(t.cycleLength, live_cycle_len) AS cycle_len
+"""
+
+def fan_in_reason(distinct_senders, window_steps):
+    return f"Fan-In Alert: Receiver got funds from {distinct_senders} distinct senders within {window_steps} step(s)."
+
 
 class FraudRules:
-    def __init__(self, graph_service):
-        self.graph_service = graph_service
+    def __init__(self, cache_size=10_000, cache_ttl=60):
+        # Repeat investigations of the same transaction skip Neo4j entirely.
+        self._explain_cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
 
-    def detect_fan_in(self, transaction_id, min_senders=5, time_window_minutes=60):
-        """
-        Rule 1: Fan-In Mule Hubs
-        Find accounts receiving funds from > N distinct senders within T minutes.
-        """
-        query = """
-        MATCH (t:TRANSACTION {id: $tx_id})
-        MATCH (receiver:Account)<-[:TRANSACTION]-(t)
-        WITH receiver
-        MATCH (sender:Account)-[other_t:TRANSACTION]->(receiver)
-        WHERE abs(duration.inSeconds(other_t.timestamp, datetime()).minutes) <= $time_window
-        WITH receiver, count(distinct sender) as distinct_senders
-        WHERE distinct_senders > $min_senders
-        RETURN distinct_senders
-        """
-        # Note: The above query assumes a specific schema. 
-        # Adapting to a more standard (Sender)-[TRANSACTION]->(Receiver) model where Transaction is a relationship.
-        
-        # Revised Query for (Account)-[t:TRANSACTION]->(Account)
-        # We need to find the receiver of the current transaction.
-        # Then check that receiver's incoming transactions.
-        
-        query = """
-        MATCH (sender:Account)-[current_tx:TRANSACTION {id: $tx_id}]->(receiver:Account)
-        WITH receiver, current_tx
-        MATCH (other_sender:Account)-[t:TRANSACTION]->(receiver)
-        WHERE t.timestamp >= current_tx.timestamp - duration({minutes: $time_window})
-          AND t.timestamp <= current_tx.timestamp
-        WITH receiver, count(distinct other_sender) as distinct_senders
-        WHERE distinct_senders > $min_senders
-        RETURN distinct_senders
-        """
-        
-        with self.graph_service.driver.session() as session:
-            result = session.run(query, tx_id=transaction_id, min_senders=min_senders, time_window=time_window_minutes)
-            record = result.single()
-            if record:
-                return f"Fan-In Alert: Receiver got funds from {record['distinct_senders']} distinct senders in {time_window_minutes} mins."
-            return None
-
-    def detect_circular_flow(self, transaction_id):
-        """
-        Rule 2: Circular Flow
-        Detect loops (A->B->C->A) involving the transaction.
+    def clear_cache(self):
+        """Drop cached explanations, e.g. after GDS scores were rewritten."""
+        self._explain_cache.clear()
+
+    async def explain_fraud(self, tx_id: str, session, min_senders=5, window_steps=1):
         """
-        query = """
-        MATCH (a:Account)-[t:TRANSACTION {id: $tx_id}]->(b:Account)
-        MATCH path = (b)-[:TRANSACTION*1..4]->(a)
-        RETURN length(path) as path_len
-        LIMIT 1
+        Cached front for _explain_fraud, keyed by transaction id and rule
+        parameters.
         """
-        
-        with self.graph_service.driver.session() as session:
-            result = session.run(query, tx_id=transaction_id)
-            record = result.single()
-            if record:
-                return f"Circular Flow Alert: Cycle of length {record['path_len'] + 1} detected involving this transaction."
-            return None
-
-    def get_gds_scores(self, tx_id: str):
-        query = """
-        MATCH (s:Client)-[t:TRANSACTED {txId: $txId}]->(r:Client)
-        RETURN 
-            s.pagerankScore AS sender_rank,
-            s.communityId   AS sender_community,
-            r.pagerankScore AS receiver_rank,
-            r.communityId   AS receiver_community
+        key = (tx_id, min_senders, window_steps)
+        explanation = self._explain_cache.get(key)
+        if explanation is None:
+            explanation = await self._explain_fraud(tx_id, session, min_senders, window_steps)
+            self._explain_cache[key] = explanation
+        return explanation
+
+    async def _explain_fraud(self, tx_id: str, session, min_senders, window_steps):
         """
-        with self.graph_service.driver.session() as session:
-            result = session.run(query, txId=tx_id)
-            record = result.single()
-
-        if record:
-            return dict(record)
-
-        return {
-            "sender_rank": 0,
-            "receiver_rank": 0,
-            "sender_community": "N/A",
-            "receiver_community": "N/A"
-        }
-
-
-    def explain_fraud(self, tx_id: str):
-        query = """
-        MATCH (s:Client)-[t:TRANSACTED {txId: $txId}]->(r:Client)
-        RETURN 
-            s.id AS sender,
-            r.id AS receiver,
-            t.amount AS amount,
-            t.type AS type,
-            t.step AS step,
-            t.isFraud AS isFraud,
-            coalesce(t.ruleFlaggedFraud, false) AS ruleFlaggedFraud
+        Explain a single transaction in one round-trip: fan-in and
+        circular-flow results are read from the properties written by
+        GraphService.precompute_rule_flags (computed live in the same query
+        when missing), together with the GDS scores of both parties.
         """
-
-        with self.graph_service.driver.session() as session:
-            result = session.run(query, txId=tx_id)
-            record = result.single()
+        record = await session.execute_read(
+            fetch_single, _EXPLAIN_Q, {"txId": tx_id, "window_steps": window_steps}
+        )
 
         if not record:
             return {
                 "status": "NOT_FOUND",
+                "transaction_id": tx_id,
                 "explanation": "Transaction ID not found in graph.",
+                "reasons": [],
                 "gds_scores": {},
             }
 
-        # ✅ FETCH GDS SCORES
-        gds_scores = self.get_gds_scores(tx_id)
+        data = {
+            key: record[key]
+            for key in ("sender", "receiver", "amount", "type", "step", "isFraud", "ruleFlaggedFraud")
+        }
+        gds_scores = {
+            "sender_rank": record["sender_rank"] or 0,
+            "receiver_rank": record["receiver_rank"] or 0,
+            "sender_community": record["sender_community"] if record["sender_community"] is not None else "N/A",
+            "receiver_community": record["receiver_community"] if record["receiver_community"] is not None else "N/A",
+        }
+
+        reasons = []
+        if record["isFraud"] == 1:
+            reasons.append("Transaction is labelled as fraud in the dataset.")
+        if record["ruleFlaggedFraud"]:
+            reasons.append("Transaction was flagged by the rule-based fraud filter.")
+
+        if record["fan_in"] > min_senders:
+            reasons.append(fan_in_reason(record["fan_in"], window_steps))
+        if record["in_cycle"]:
+            reasons.append(f"Circular Flow Alert: Cycle of length {record['cycle_len']} detected involving this transaction.")
 
         if record["isFraud"] == 1 or record["ruleFlaggedFraud"]:
             return {
                 "status": "FRAUD",
+                "transaction_id": tx_id,
                 "explanation": "Transaction matches fraud indicators.",
-                "data": dict(record),
+                "reasons": reasons,
+                "data": data,
                 "gds_scores": gds_scores
             }
 
         return {
             "status": "CLEARED",
+            "transaction_id": tx_id,
             "explanation": "No specific fraud patterns detected.",
-            "data": dict(record),
+            "reasons": reasons,
+            "data": data,
             "gds_scores": gds_scores
         }
 
 
 
-fraud_rules = FraudRules(graph_service)
+fraud_rules = FraudRules()
@@ -1,91 +1,371 @@
-from neo4j import GraphDatabase
+from neo4j import AsyncGraphDatabase, READ_ACCESS
 from app.core.config import settings
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
 
 class GraphService:
     def __init__(self):
-        self.driver = GraphDatabase.driver(
+        # Opened by connect() from the FastAPI startup hook, so every worker
+        # process gets its own driver and importing this module does no I/O.
+        self.driver = None
+
+    async def connect(self):
+        if self.driver is not None:
+            return
+        self.driver = AsyncGraphDatabase.driver(
             settings.NEO4J_URI,
-            auth=(settings.NEO4J_USER, settings.NEO4J_PASSWORD)
+            auth=(settings.NEO4J_USER, settings.NEO4J_PASSWORD),
+            max_connection_pool_size=64,
+            connection_acquisition_timeout=15.0,
+            max_connection_lifetime=3600,
+            connection_timeout=5.0,
+            keep_alive=True,
+            # Ping connections that sat idle this long before handing them out
+            liveness_check_timeout=30.0,
+            fetch_size=1000
         )
 
-    def close(self):
-        self.driver.close()
+    async def close(self):
+        if self.driver is not None:
+            await self.driver.close()
+            self.driver = None
 
-    def check_connection(self):
+    async def check_connection(self):
         try:
-            with self.driver.session() as session:
-                result = session.run("RETURN 1")
-                return result.single()[0] == 1
+            async with self.driver.session(database=settings.NEO4J_DATABASE, default_access_mode=READ_ACCESS) as session:
+                record = await session.execute_read(fetch_single, "RETURN 1")
+                return record[0] == 1
         except Exception as e:
             logger.error(f"Failed to connect to Neo4j: {e}")
             return False
 
-    def run_gds_pipeline(self, projection_name="fraud_graph"):
+    async def ensure_indexes(self):
+        """
+        Create the schema every investigation query relies on, so the
+        txId / client id lookups are index seeks instead of full scans.
+        Idempotent: safe to run on every startup.
+        """
+        statements = [
+            "CREATE CONSTRAINT client_id IF NOT EXISTS FOR (c:Client) REQUIRE c.id IS UNIQUE",
+            "CREATE INDEX tx_txid IF NOT EXISTS FOR ()-[t:TRANSACTED]-() ON (t.txId)",
+            "CREATE INDEX tx_step IF NOT EXISTS FOR ()-[t:TRANSACTED]-() ON (t.step)",
+            "CREATE INDEX client_rank IF NOT EXISTS FOR (c:Client) ON (c.pagerankScore)",
+        ]
+        async with self.driver.session(database=settings.NEO4J_DATABASE) as session:
+            for statement in statements:
+                result = await session.run(statement)
+                await result.consume()
+        logger.info("Neo4j indexes and constraints ensured.")
+
+    async def run_gds_pipeline(self, projection_name="fraud_graph"):
         """
         Orchestrates the GDS pipeline:
-        1. Create Projection
-        2. Run Louvain (Community Detection)
-        3. Run PageRank (Centrality)
+        1. Create Projection (only if missing or stale)
+        2. Check the Louvain and PageRank memory estimates against free heap
+        3. Run Louvain (Community Detection)
+        4. Run PageRank (Centrality)
+        Results are streamed and written back with apoc.periodic.iterate,
+        one transaction per 10k nodes.
         """
-        with self.driver.session() as session:
-            # 1. Drop projection if exists
-            session.run(f"""
-                CALL gds.graph.drop('{projection_name}', false)
-            """)
+        async with self.driver.session(database=settings.NEO4J_DATABASE) as session:
+            # 1. Re-use the projection unless it no longer matches the data
+            result = await session.run("""
+                CALL gds.graph.exists($name) YIELD exists
+                RETURN exists
+            """, name=projection_name)
+            exists = (await result.single())["exists"]
 
-            # 2. Create Projection (Native Projection)
-            # Assuming 'Client' and 'Transaction' nodes, and 'PERFORMS', 'BENEFICIARY' relationships
-            # Adjusting to PaySim schema: usually 'Client' nodes and 'TRANSACTION' relationships?
-            # PaySim: Node types: Customer, Merchant. Rel: TRANSACTION.
-            # Let's assume a simple monopartite graph for now: Account -> [TRANSACTION] -> Account
-            # Or bipartite: Account -> Transaction -> Account.
-            # The prompt mentions "Fan-In Mule Hubs" and "Circular Flow", implying Account-to-Account flow.
-            # Let's project 'Account' nodes and 'TRANSACTION' relationships (aggregated).
-            
-            # For PaySim, usually it's (Customer)-[:TRANSACTION]->(Customer/Merchant)
-            # We'll project all nodes with label 'Account' (or whatever the user has) and 'TRANSACTION' rels.
-            # Safest generic projection:
-            
-            create_query = f"""
-            CALL gds.graph.project(
-                '{projection_name}',
-                '*',
-                'TRANSACTION',
-                {{
-                    relationshipProperties: 'amount'
-                }}
-            )
+            stale = False
+            if exists:
+                result = await session.run("""
+                    CALL gds.graph.list($name) YIELD relationshipCount
+                    RETURN relationshipCount <> COUNT { (:Client)-[:TRANSACTED]->(:Client) } AS stale
+                """, name=projection_name)
+                stale = (await result.single())["stale"]
+                if stale:
+                    result = await session.run("""
+                        CALL gds.graph.drop($name, false)
+                    """, name=projection_name)
+                    await result.consume()
+
+            if not exists or stale:
+                # Monopartite, unweighted Client -[TRANSACTED]-> Client graph
+                create_query = """
+                CALL gds.graph.project(
+                    $name,
+                    'Client',
+                    'TRANSACTED'
+                )
+                """
+                result = await session.run(create_query, name=projection_name)
+                await result.consume()
+                logger.info(f"Graph projection '{projection_name}' created.")
+
+            # 2. Fail fast instead of letting Louvain or PageRank exhaust the heap
+            estimate_query = """
+            CALL gds.louvain.stream.estimate($name, {}) YIELD bytesMax AS louvainBytes
+            CALL gds.pageRank.stream.estimate($name, {}) YIELD bytesMax AS pagerankBytes
+            CALL gds.systemMonitor() YIELD freeHeap, availableCPUs
+            RETURN louvainBytes, pagerankBytes, freeHeap, availableCPUs
             """
-            session.run(create_query)
-            logger.info(f"Graph projection '{projection_name}' created.")
-
-            # 3. Run Louvain (Write back communityId)
-            louvain_query = f"""
-            CALL gds.louvain.write(
-                '{projection_name}',
-                {{
-                    writeProperty: 'communityId'
-                }}
+            result = await session.run(estimate_query, name=projection_name)
+            estimate = await result.single()
+            for algorithm, key in (("Louvain", "louvainBytes"), ("PageRank", "pagerankBytes")):
+                if estimate[key] > estimate["freeHeap"]:
+                    raise RuntimeError(
+                        f"{algorithm} needs up to {estimate[key]} bytes but only "
+                        f"{estimate['freeHeap']} bytes of heap are free."
+                    )
+            concurrency = min(estimate["availableCPUs"], settings.GDS_CONCURRENCY)
+
+            # 3. Run Louvain (Stream, write back communityId in batches)
+            louvain_query = """
+            CALL apoc.periodic.iterate(
+                'CALL gds.louvain.stream($name, {concurrency: $concurrency})
+                 YIELD nodeId, communityId
+                 RETURN gds.util.asNode(nodeId) AS c, communityId',
+                'SET c.communityId = communityId',
+                {batchSize: 10000, parallel: true, params: {name: $name, concurrency: $concurrency}}
             )
+            YIELD batches, total, errorMessages
+            RETURN batches, total, errorMessages
             """
-            session.run(louvain_query)
+            result = await session.run(louvain_query, name=projection_name, concurrency=concurrency)
+            self._check_batches(await result.single(), "Louvain")
             logger.info("Louvain algorithm executed.")
 
-            # 4. Run PageRank (Write back rankScore)
-            pagerank_query = f"""
-            CALL gds.pageRank.write(
-                '{projection_name}',
-                {{
-                    maxIterations: 20,
-                    dampingFactor: 0.85,
-                    writeProperty: 'rankScore'
-                }}
+            # 4. Run PageRank (Stream, write back pagerankScore in batches)
+            pagerank_query = """
+            CALL apoc.periodic.iterate(
+                'CALL gds.pageRank.stream($name, {maxIterations: 20, dampingFactor: 0.85, concurrency: $concurrency})
+                 YIELD nodeId, score
+                 RETURN gds.util.asNode(nodeId) AS c, score',
+                'SET c.pagerankScore = score',
+                {batchSize: 10000, parallel: true, params: {name: $name, concurrency: $concurrency}}
             )
+            YIELD batches, total, errorMessages
+            RETURN batches, total, errorMessages
             """
-            session.run(pagerank_query)
+            result = await session.run(pagerank_query, name=projection_name, concurrency=concurrency)
+            self._check_batches(await result.single(), "PageRank")
             logger.info("PageRank algorithm executed.")
 
+    @staticmethod
+    def _check_batches(record, step):
+        if record["errorMessages"]:
+            raise RuntimeError(f"{step} write-back failed: {record['errorMessages']}")
+        logger.info(f"{step} wrote {record['total']} rows in {record['batches']} batches.")
+
+    async def precompute_rule_flags(self, window_steps=1):
+        """
+        Store the fraud-rule results on every transaction so investigations
+        only read properties:
+        - t.fanInScore: distinct senders into the receiver within the last
+          window_steps steps
+        - t.inCycle / t.cycleLength: whether money returns to the sender in
+          at most 4 hops, and the length of that cycle
+        """
+        # Integer step range expanded from the bound receiver; the planner
+        # may still use tx_step, but no hint forces a graph-wide range seek.
+        fan_in_query = """
+        CALL apoc.periodic.iterate(
+            'MATCH (:Client)-[t:TRANSACTED]->(r:Client) RETURN t, r',
+            'MATCH (o:Client)-[ot:TRANSACTED]->(r)
+             WHERE ot.step >= t.step - $window_steps AND ot.step <= t.step
+             WITH t, count(DISTINCT o) AS fan_in
+             SET t.fanInScore = fan_in',
+            {batchSize: 10000, parallel: false, params: {window_steps: $window_steps}}
+        )
+        YIELD batches, total, errorMessages
+        RETURN batches, total, errorMessages
+        """
+        # Self-transfers (a = b) skip shortestPath, which rejects them, and
+        # are stored as inCycle = false.
+        cycle_query = """
+        CALL apoc.periodic.iterate(
+            'MATCH (a:Client)-[t:TRANSACTED]->(b:Client) RETURN t, a, b',
+            'CALL {
+                 WITH a, b
+                 WITH a, b WHERE a <> b
+                 OPTIONAL MATCH path = shortestPath((b)-[:TRANSACTED*..4]->(a))
+                 RETURN min(length(path)) AS path_len
+             }
+             SET t.inCycle = path_len IS NOT NULL, t.cycleLength = path_len + 1',
+            {batchSize: 10000, parallel: false}
+        )
+        YIELD batches, total, errorMessages
+        RETURN batches, total, errorMessages
+        """
+        async with self.driver.session(database=settings.NEO4J_DATABASE) as session:
+            result = await session.run(fan_in_query, window_steps=window_steps)
+            self._check_batches(await result.single(), "Fan-in precompute")
+
+            result = await session.run(cycle_query)
+            self._check_batches(await result.single(), "Circular-flow precompute")
+
+    async def export_edges(self, batch_size=50_000):
+        """
+        Stream the Client -[TRANSACTED]-> Client edge list out of Neo4j as
+        batches of (sender, receiver) tuples.
+        """
+        async with self.driver.session(database=settings.NEO4J_DATABASE) as session:
+            result = await session.run("""
+                MATCH (s:Client)-[t:TRANSACTED]->(r:Client)
+                RETURN s.id AS sender, r.id AS receiver
+            """)
+            batch = []
+            async for record in result:
+                batch.append((record["sender"], record["receiver"]))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+    async def write_scores(self, rows, batch_size=10_000):
+        """
+        Write {id, rank, comm} rows back onto Client nodes, one UNWIND
+        statement per batch.
+        """
+        query = """
+        UNWIND $rows AS row
+        MATCH (c:Client {id: row.id})
+        SET c.pagerankScore = row.rank, c.communityId = row.comm
+        """
+        async with self.driver.session(database=settings.NEO4J_DATABASE) as session:
+            for start in range(0, len(rows), batch_size):
+                result = await session.run(query, rows=rows[start:start + batch_size])
+                await result.consume()
+
+    async def run_offline_pipeline(self):
+        """
+        Alternative to run_gds_pipeline that keeps the heavy compute out of
+        the database process:
+        1. Export the edge list, adding each batch to a NetworKit graph
+        2. Run PageRank and Louvain (PLM) with NetworKit
+        3. Write the scores back in batches
+        """
+        import networkit as nk
+
+        graph = nk.Graph(directed=True)
+        index = {}
+        edge_count = 0
+        async for batch in self.export_edges():
+            await asyncio.to_thread(add_edges, graph, index, batch)
+            edge_count += len(batch)
+        logger.info(f"Exported {edge_count} edges.")
+        if edge_count == 0:
+            # NetworKit PageRank cannot run on an empty graph
+            logger.info("No Client transactions to score.")
+            return
+
+        rows = await asyncio.to_thread(compute_scores, graph, index)
+        logger.info("NetworKit PageRank and Louvain executed.")
+
+        await self.write_scores(rows)
+        logger.info(f"Scores written back for {len(rows)} clients.")
+
+def add_edges(graph, index, edges):
+    """
+    Add (sender, receiver) edges to an unweighted NetworKit graph, mapping
+    client ids to node ids in index. Like the GDS projection, parallel
+    transactions stay separate edges and amounts are not used as weights.
+    """
+    for sender, receiver in edges:
+        for client in (sender, receiver):
+            if client not in index:
+                index[client] = graph.addNode()
+        graph.addEdge(index[sender], index[receiver])
+
+def compute_scores(graph, index):
+    """
+    Compute PageRank and Louvain communities for a graph built by
+    add_edges with NetworKit.
+    """
+    import networkit as nk
+
+    pagerank = nk.centrality.PageRank(graph, damp=0.85)
+    pagerank.run()
+    ranks = pagerank.scores()
+
+    # PLM (Louvain) works on undirected graphs
+    plm = nk.community.PLM(nk.graphtools.toUndirected(graph), refine=True)
+    plm.run()
+    communities = plm.getPartition()
+
+    return [
+        {"id": client, "rank": ranks[node], "comm": communities[node]}
+        for client, node in index.items()
+    ]
+
+async def fetch_single(tx, query, params=None):
+    """Transaction function for session.execute_read: first record or None."""
+    result = await tx.run(query, params)
+    return await result.single()
+
+def neighbourhood_to_graph(record):
+    """
+    Turn the single row of the investigation neighbourhood query into a
+    {"nodes": [...], "edges": [...]} payload for vis-network.
+    """
+    if record is None:
+        return {"nodes": [], "edges": []}
+
+    nodes = {}
+    # Keyed by the unordered client pair, so the transaction edge is not
+    # drawn again as a neighbour link.
+    edges = {}
+
+    def pair(a, b):
+        return "-".join(sorted((str(a["id"]), str(b["id"]))))
+
+    def add_node(client):
+        nodes[client["id"]] = {
+            "id": client["id"],
+            "label": str(client["id"]),
+            "value": client["pagerankScore"] or 0,
+            "group": client["communityId"],
+        }
+
+    sender, receiver = record["sender"], record["receiver"]
+    add_node(sender)
+    add_node(receiver)
+    edges[pair(sender, receiver)] = {
+        "id": "tx",
+        "from": sender["id"],
+        "to": receiver["id"],
+        "value": record["amount"] or 0,
+        "title": record["type"],
+        "arrows": "to",
+        "fraud": record["isFraud"] == 1,
+    }
+
+    for centre, neighbours in ((sender, record["n1s"]), (receiver, record["n2s"])):
+        for neighbour in neighbours:
+            add_node(neighbour)
+            edge_id = pair(centre, neighbour)
+            edges.setdefault(edge_id, {
+                "id": edge_id,
+                "from": centre["id"],
+                "to": neighbour["id"],
+                "dashes": True,
+                "fraud": False,
+            })
+    return {"nodes": list(nodes.values()), "edges": list(edges.values())}
+
 graph_service = GraphService()
+
+async def get_session():
+    """
+    FastAPI dependency: one read session per request, shared by every query
+    the request issues. Reads go through session.execute_read so transient
+    failures are retried and clusters can route them to followers.
+    """
+    async with graph_service.driver.session(
+        database=settings.NEO4J_DATABASE,
+        default_access_mode=READ_ACCESS,
+        fetch_size=100
+    ) as session:
+        yield session
@@ -2,6 +2,10 @@ from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from app.routers import investigation
+from app.services.graph_service import graph_service
+import logging
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Explainable Fraud-Ring Detection System")
 
@@ -13,6 +17,20 @@ app.include_router(investigation.router)
 
 templates = Jinja2Templates(directory="app/templates")
 
+@app.on_event("startup")
+async def connect_graph():
+    await graph_service.connect()
+    # Missing indexes only cost speed; an unreachable Neo4j or a conflicting
+    # constraint must not stop the app from serving (errors surface per request).
+    try:
+        await graph_service.ensure_indexes()
+    except Exception:
+        logger.exception("Could not ensure Neo4j indexes and constraints.")
+
+@app.on_event("shutdown")
+async def close_driver():
+    await graph_service.close()
+
 @app.get("/")
 async def root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
@@ -26,7 +26,7 @@ def verify():
         graph_service = GraphService()
         print("[OK] GraphService instantiated")
         
-        rules = FraudRules(graph_service)
+        rules = FraudRules()
         print("[OK] FraudRules instantiated")
         
         # Don't actually connect to DB as it might not be running